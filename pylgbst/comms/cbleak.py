@@ -1,16 +1,38 @@
 import asyncio
 import logging
 import platform
-import queue
 import threading
-import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 import bleak
+import bleak.exc
 
 from pylgbst.comms import Connection, MOVE_HUB_HW_UUID_CHAR, MOVE_HUB_HW_UUID_SERV
 
 log = logging.getLogger('comms-bleak')
 
+SCAN_TIMEOUT = 30
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _get_loop():
+    """
+    Return event loop shared by all drivers, starting its thread on first use.
+
+    :return: Running event loop.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever, name='bleak-loop')
+            thread.daemon = True
+            thread.start()
+    return _loop
+
 
 class BleakDriver(Connection):
     """Driver that provides interface between API and Bleak."""
@@ -25,12 +47,14 @@ class BleakDriver(Connection):
         self.hub_name = hub_name
         self._handler = None
         self._abort = False
-        self._connection_thread = None
-        self._processing_thread = None
+        self._loop = None
+        self._connection_future = None
+        self._sending = False
+        self._handler_executor = None
 
-        # Queues to handle request / responses. Acts as a buffer between API and async BLE driver
-        self.resp_queue = queue.Queue()
-        self.req_queue = queue.Queue()
+        # Queue to handle requests. Acts as a buffer between API and async BLE driver,
+        # it is an asyncio one and is created on the driver's loop in `enable_notifications`
+        self.req_queue = None
 
     def set_notify_handler(self, handler):
         """
@@ -43,72 +67,111 @@ class BleakDriver(Connection):
 
     def enable_notifications(self):
         """
-        Enable notifications, in our cases starts communication threads.
+        Enable notifications, in our cases starts communication task on the shared loop.
 
         We cannot do this earlier, because API need to fist set notification handler.
         :return: None
         """
-        self._connection_thread = threading.Thread(target=lambda: asyncio.run(self._bleak_thread()))
-        self._connection_thread.daemon = True
-        self._connection_thread.start()
+        # handler must not block the shared BLE loop, single worker keeps notifications in order
+        self._handler_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bleak-handler')
+        self._loop = _get_loop()
+        # queue has to exist before first write is scheduled
+        asyncio.run_coroutine_threadsafe(self._create_queues(), self._loop).result()
+        self._connection_future = asyncio.run_coroutine_threadsafe(self._bleak_thread(), self._loop)
+        self._connection_future.add_done_callback(self._connection_done)
+
+    async def _create_queues(self):
+        # asyncio primitives have to be bound to the driver's loop, not to the caller's one
+        self.req_queue = asyncio.Queue()
 
-        self._processing_thread = threading.Thread(target=self._processing)
-        self._processing_thread.daemon = True
-        self._processing_thread.start()
+    @staticmethod
+    def _connection_done(future):
+        if not future.cancelled() and future.exception() is not None:
+            log.error("Communications failed: %s", future.exception(), exc_info=future.exception())
 
     async def _bleak_thread(self):
-        bleak = BleakConnection()
+        bleak = BleakConnection(disconnected_callback=self._connection_lost)
         # For MacOS 12+ the service_uuids kwarg is required for scanning
         kwargs = {}
         if "Darwin" == platform.system() and int(platform.mac_ver()[0].split(".")[0]) >= 12:
             kwargs = {"service_uuids": [MOVE_HUB_HW_UUID_SERV]}
-        await bleak.connect(self.hub_mac, self.hub_name, **kwargs)
-        await bleak.set_notify_handler((self._safe_handler, self.resp_queue))
-        # After connecting, need to send any data or hub will drop the connection,
-        # below command is Advertising name request update
-        await bleak.write_char(MOVE_HUB_HW_UUID_CHAR, bytearray([0x05, 0x00, 0x01, 0x01, 0x05]))
-        while not self._abort:
-            await asyncio.sleep(0.1)
-            if self.req_queue.qsize() != 0:
-                data = self.req_queue.get()
-                await bleak.write(data[0], data[1])
-
-        logging.info("Communications thread has exited")
-
-    @staticmethod
-    def _safe_handler(handler, data, resp_queue):
-        resp_queue.put((handler, data))
-
-    def _processing(self):
-        while not self._abort:
-            if self.resp_queue.qsize() != 0:
-                msg = self.resp_queue.get()
-                self._handler(msg[0], bytes(msg[1]))
-
-            time.sleep(0.01)
-        logging.info("Processing thread has exited")
+        try:
+            await bleak.connect(self.hub_mac, self.hub_name, **kwargs)
+            await bleak.set_notify_handler(self._safe_handler)
+            # After connecting, need to send any data or hub will drop the connection,
+            # below command is Advertising name request update
+            await bleak.write_char(MOVE_HUB_HW_UUID_CHAR, bytearray([0x05, 0x00, 0x01, 0x01, 0x05]))
+            self._sending = True
+            while True:
+                # drain everything piled up meanwhile, so a burst is written without extra loop wake-ups
+                batch = [await self.req_queue.get()]
+                while not self.req_queue.empty():
+                    batch.append(self.req_queue.get_nowait())
+
+                for request in batch:
+                    if request is None:  # put by disconnect() behind writes queued before it
+                        return
+                    await bleak.write(*request)
+        finally:
+            # loop is shared and outlives the driver, so connection has to be closed explicitly
+            await bleak.disconnect()
+            logging.info("Communications task has exited")
+
+    def _connection_lost(self, connection):
+        log.warning("Connection to hub is lost")
+        self._sending = False  # nothing can be written anymore, stop right away
+        self.disconnect()
+
+    def _safe_handler(self, handle, data):
+        if self._abort:
+            return
+
+        try:
+            self._handler_executor.submit(self._call_handler, handle, bytes(data))
+        except RuntimeError:
+            # executor got shut down by disconnect() or interpreter exit meanwhile
+            log.debug("Dropped notification on %s after shutdown", handle)
+
+    def _call_handler(self, handle, data):
+        try:
+            self._handler(handle, data)
+        except BaseException:
+            log.error("Failed to handle notification: %s", traceback.format_exc())
 
     def write(self, handle, data):
         """
         Send data to given handle number.
 
         :param handle: Handle number that will be translated into characteristic uuid
-        :param data: data to send
-        :raises ConnectionError" When internal threads are not working
+        :param data: data to send, bytes or bytearray
+        :raises ConnectionError" When communication task is not working
         :return: None
         """
-        if not self._connection_thread.is_alive() or not self._processing_thread.is_alive():
-            raise ConnectionError('Something went wrong, communication threads not functioning.')
+        if not self.is_alive():
+            raise ConnectionError('Something went wrong, communication task not functioning.')
 
-        self.req_queue.put((handle, data))
+        self._loop.call_soon_threadsafe(self.req_queue.put_nowait, (handle, data))
 
     def disconnect(self):
         """
-        Disconnect and stops communication threads.
+        Disconnect and stops communication task.
 
+        Writes queued before the call are still sent, then the connection is closed.
+        If the hub is not connected yet, connecting is cancelled instead.
         :return: None
         """
         self._abort = True
+        if self._connection_future is not None:
+            self._loop.call_soon_threadsafe(self._stop)
+        if self._handler_executor is not None:
+            self._handler_executor.shutdown(wait=False)
+
+    def _stop(self):
+        # runs on the loop, so it is ordered after every put_nowait() scheduled by write()
+        if self._sending:
+            self.req_queue.put_nowait(None)
+        else:
+            self._connection_future.cancel()
 
     def is_alive(self):
         """
@@ -116,8 +179,8 @@ class BleakDriver(Connection):
 
         :return: True if driver is functioning; False otherwise.
         """
-        if self._connection_thread is not None and self._processing_thread is not None:
-            return self._connection_thread.is_alive() and self._processing_thread.is_alive()
+        if self._connection_future is not None:
+            return not self._connection_future.done()
         else:
             return False
 
@@ -125,12 +188,22 @@ class BleakDriver(Connection):
 class BleakConnection(Connection):
     """Bleak driver for communicating with BLE device."""
 
-    def __init__(self):
-        """Initialize new instance of BleakConnection class."""
+    def __init__(self, disconnected_callback=None):
+        """
+        Initialize new instance of BleakConnection class.
+
+        :param disconnected_callback: Optional function called with this connection when device disconnects
+        """
         Connection.__init__(self)
 
+        self._disconnected_callback = disconnected_callback
         self._device = None
         self._client = None
+        self._connected = False
+        self._notifying = False
+        self._disconnecting = False
+        self._hw_char = MOVE_HUB_HW_UUID_CHAR  # replaced by resolved characteristic object on connect
+        self._desc_cache = {}  # handle -> characteristic to write into
         logging.getLogger('bleak.backends.dotnet.client').setLevel(logging.WARNING)
         logging.getLogger('bleak.backends.bluezdbus.client').setLevel(logging.WARNING)
 
@@ -140,33 +213,36 @@ class BleakConnection(Connection):
 
         :param hub_mac: Optional Lego HUB MAC to connect to
         :param hub_name: Optional Lego Hub name to connect to
-        :kwargs: Optional parameters for bleak.discover
+        :kwargs: Optional parameters for bleak.BleakScanner
 
         :raises ConnectionError: When cannot connect to given MAC or name matching fails.
         :return: None
         """
         log.info("Discovering devices... Press green button on Hub")
-        for i in range(0, 30):
-            devices = await bleak.discover(timeout=1, **kwargs)
-            log.debug("Devices: %s", devices)
-            for dev in devices:
-                log.debug(dev)
-                address = dev.address
-                name = dev.name
-                if self._is_device_matched(address, name, hub_mac, hub_name):
-                    log.info('Device matched: %r', dev)
-                    self._device = dev
-                    break
-            else:
-                continue
-
-            break
-        else:
+        found = asyncio.get_running_loop().create_future()
+
+        def detection_callback(dev, advertisement_data):
+            log.debug(dev)
+            if not found.done() and self._is_device_matched(dev.address, dev.name, hub_mac, hub_name):
+                found.set_result(dev)
+
+        scanner = bleak.BleakScanner(detection_callback=detection_callback, **kwargs)
+        await scanner.start()
+        try:
+            self._device = await asyncio.wait_for(found, timeout=SCAN_TIMEOUT)
+        except asyncio.TimeoutError:
             raise ConnectionError('Device not found.')
+        finally:
+            await scanner.stop()
 
-        self._client = bleak.BleakClient(self._device)
+        log.info('Device matched: %r', self._device)
+
+        self._client = bleak.BleakClient(self._device, disconnected_callback=self._on_disconnected)
         status = await self._client.connect()
+        self._connected = True
         log.debug('Connection status: {status}'.format(status=status))
+        # resolve default characteristic once, so Bleak does not look it up by uuid on every write
+        self._hw_char = self._client.services.get_characteristic(MOVE_HUB_HW_UUID_CHAR) or MOVE_HUB_HW_UUID_CHAR
 
     async def write(self, handle, data):
         """
@@ -174,20 +250,19 @@ class BleakConnection(Connection):
 
         If handle cannot be found in service description, hardcoded LEGO uuid will be used.
         :param handle: Handle number that will be translated into characteristic uuid
-        :param data: data to send
+        :param data: data to send, bytes or bytearray
         :return: None
         """
-        log.debug('Request: {handle} {payload}'.format(handle=handle, payload=[hex(x) for x in data]))
-        desc = self._client.services.get_descriptor(handle)
-
-        if not isinstance(data, bytearray):
-            data = bytearray(data)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('Request: {handle} {payload}'.format(handle=handle, payload=[hex(x) for x in data]))
+        char = self._desc_cache.get(handle)
+        if char is None:
+            desc = self._client.services.get_descriptor(handle)
+            # if dedicated handle not found, send by using LEGO Move Hub default characteristic
+            char = self._hw_char if desc is None else desc.characteristic_uuid
+            self._desc_cache[handle] = char
 
-        if desc is None:
-            # dedicated handle not found, try to send by using LEGO Move Hub default characteristic
-            await self._client.write_gatt_char(MOVE_HUB_HW_UUID_CHAR, data)
-        else:
-            await self._client.write_gatt_char(desc.characteristic_uuid, data)
+        await self._client.write_gatt_char(char, data)
 
     async def write_char(self, characteristic_uuid, data):
         """
@@ -199,26 +274,59 @@ class BleakConnection(Connection):
         """
         await self._client.write_gatt_char(characteristic_uuid, data)
 
-    async def set_notify_handler(self, inputs):
+    async def set_notify_handler(self, handler):
         """
         Set notification handler.
 
         :param handler: Handle function to be called when receive any data.
         :return: None
         """
-        handler, resp_queue = inputs
 
         def c(handle, data):
-            log.debug('Response: {handle} {payload}'.format(handle=handle, payload=[hex(x) for x in data]))
-            handler(handle, data, resp_queue)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('Response: {handle} {payload}'.format(handle=handle, payload=[hex(x) for x in data]))
+            handler(handle, data)
+
+        await self._client.start_notify(self._hw_char, c)
+        self._notifying = True
+
+    async def disconnect(self):
+        """
+        Disconnect from device.
 
-        await self._client.start_notify(MOVE_HUB_HW_UUID_CHAR, c)
+        Notifications are stopped first, so no late responses arrive while tearing down.
+        :return: None
+        """
+        if self._client is None:
+            return
+
+        # BlueZ and WinRT report our own disconnect through the callback as well
+        self._disconnecting = True
+        try:
+            if self._connected and self._notifying:
+                self._notifying = False
+                await self._client.stop_notify(self._hw_char)
+        except bleak.exc.BleakError as exc:
+            log.warning("Failed to stop notifications: %s", exc)
+        finally:
+            # client may be half-open after cancelled connect or dropped link, release it anyway
+            try:
+                await self._client.disconnect()
+            except bleak.exc.BleakError as exc:
+                log.warning("Failed to disconnect: %s", exc)
+
+    def _on_disconnected(self, client):
+        log.debug('Disconnected from %s', client)
+        self._connected = False
+        self._notifying = False
+        if self._disconnected_callback is not None and not self._disconnecting:
+            self._disconnected_callback(self)
 
     def is_alive(self):
         """
-        To keep compatibility with the driver interface.
+        Indicate whether device is connected.
 
-        This method does nothing.
-        :return: None.
+        State is maintained by Bleak's disconnected callback, so no backend round-trip is made.
+        :return: True if device is connected; False otherwise.
         """
-        pass
+        return self._connected
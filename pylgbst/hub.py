@@ -249,11 +249,7 @@ class MoveHub(Hub):
         if connection is None:
             connection = get_connection_auto(hub_name=self.DEFAULT_NAME)
 
-        super().__init__(connection)
-        self.info = {}
-
-        # shorthand fields
-        self.button = Button(self)
+        # shorthand fields, set before connection starts to deliver attach notifications
         self.led = None
         self.current = None
         self.voltage = None
@@ -266,6 +262,10 @@ class MoveHub(Hub):
         self.port_C = None
         self.port_D = None
 
+        super().__init__(connection)
+        self.info = {}
+        self.button = Button(self)
+
         self._wait_for_devices()
         self._report_status()
 
@@ -360,15 +360,15 @@ class SmartHub(Hub):
         if connection is None:
             connection = get_connection_auto(hub_name=self.DEFAULT_NAME)
 
-        super().__init__(connection)
-
-        self.button = Button(self)
         self.led = None
         self.port_A = None
         self.port_B = None
         self.current = None
         self.voltage = None
 
+        super().__init__(connection)
+        self.button = Button(self)
+
         self._wait_for_devices()
 
     def _wait_for_devices(self, get_dev_set=None):
@@ -428,14 +428,14 @@ class RemoteHandset(Hub):
         if connection is None:
             connection = get_connection_auto(hub_mac=address, hub_name=self.DEFAULT_NAME)
 
-        super().__init__(connection)
-
         self.led = None
         self.port_A = None
         self.port_B = None
         self.port_RSSI = None
         self.voltage = None
 
+        super().__init__(connection)
+
         self._wait_for_devices()
 
     def _wait_for_devices(self, get_dev_set=None):
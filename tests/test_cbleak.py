@@ -1,20 +1,63 @@
+import asyncio
 import sys
+import threading
 import time
 import unittest
+from unittest import mock
 
 import bleak
+import bleak.exc
 from packaging import version
 
 import pylgbst
 import pylgbst.comms.cbleak as cbleak
 
 bleak.BleakClient = object()
-bleak.discover = object()
+bleak.BleakScanner = object()
 
 last_response = None
 lt37 = version.parse(sys.version.split(' ')[0]) < version.parse("3.7")
 
 
+class FakeConnection:
+    """Stands in for BleakConnection inside BleakDriver._bleak_thread."""
+    instances = []
+    fail_connect = False
+
+    def __init__(self, disconnected_callback=None):
+        self.disconnected_callback = disconnected_callback
+        self.calls = []
+        self.writes = []
+        self.connected = threading.Event()
+        FakeConnection.instances.append(self)
+
+    async def connect(self, hub_mac=None, hub_name=None, **kwargs):
+        self.calls.append('connect')
+        if self.fail_connect:
+            raise ConnectionError('Device not found.')
+        self.connected.set()
+
+    async def set_notify_handler(self, handler):
+        self.calls.append('set_notify_handler')
+
+    async def write_char(self, characteristic_uuid, data):
+        self.calls.append('write_char')
+
+    async def write(self, handle, data):
+        self.calls.append('write')
+        self.writes.append((handle, data))
+
+    async def disconnect(self):
+        self.calls.append('disconnect')
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
 class BleakDriverTest(unittest.TestCase):
     def test_driver_creation(self):
         connection = pylgbst.get_connection_bleak()
@@ -28,11 +71,12 @@ class BleakDriverTest(unittest.TestCase):
         async def fake_thread():
             print('Fake thread initialized')
             while not driver._abort:
-                time.sleep(0.1)
-                if driver.req_queue.qsize() != 0:
-                    print('Received data, sending back')
-                    data = driver.req_queue.get()
-                    driver.resp_queue.put(data)
+                try:
+                    data = await asyncio.wait_for(driver.req_queue.get(), 0.1)
+                except asyncio.TimeoutError:
+                    continue
+                print('Received data, sending back')
+                driver._safe_handler(*data)
 
         driver._bleak_thread = fake_thread
         driver.set_notify_handler(BleakDriverTest.validation_handler)
@@ -41,21 +85,326 @@ class BleakDriverTest(unittest.TestCase):
         time.sleep(0.5)  # time for driver initialization
         self.assertTrue(driver.is_alive(), 'Checking that driver starts')
         handle = 0x32
-        data = [0xD, 0xE, 0xA, 0xD, 0xB, 0xE, 0xE, 0xF]
+        data = bytes([0xD, 0xE, 0xA, 0xD, 0xB, 0xE, 0xE, 0xF])
         driver.write(handle, data)
         time.sleep(0.5)  # processing time
         self.assertEqual(handle, last_response[0], 'Verifying response handle')
-        self.assertEqual(bytes(data), last_response[1], 'Verifying response data')
+        self.assertEqual(data, last_response[1], 'Verifying response data')
 
         driver.disconnect()
         time.sleep(0.5)  # processing time
         self.assertFalse(driver.is_alive())
 
+    @unittest.skipIf(lt37, "Python version is too low")
+    def test_connection_lost(self):
+        FakeConnection.instances.clear()
+        driver = cbleak.BleakDriver(hub_name='LEGO Move Hub')
+        driver.set_notify_handler(BleakDriverTest.validation_handler)
+        with mock.patch.object(cbleak, 'BleakConnection', FakeConnection):
+            driver.enable_notifications()
+            self.assertTrue(wait_until(lambda: FakeConnection.instances))
+        conn = FakeConnection.instances[0]
+        self.assertTrue(conn.connected.wait(2))
+        self.assertTrue(driver.is_alive())
+
+        driver._loop.call_soon_threadsafe(conn.disconnected_callback, conn)
+        self.assertTrue(wait_until(lambda: not driver.is_alive()), 'Driver stops when hub disconnects')
+        with self.assertRaises(ConnectionError):
+            driver.write(0x0E, b'\x01')
+
+    @unittest.skipIf(lt37, "Python version is too low")
+    def test_own_disconnect_is_not_lost_connection(self):
+        driver = cbleak.BleakDriver(hub_name='LEGO Move Hub')
+        driver.set_notify_handler(BleakDriverTest.validation_handler)
+        with mock.patch.object(cbleak.bleak, 'BleakScanner', ScannerMock), \
+                mock.patch.object(cbleak.bleak, 'BleakClient', NotifyingClientMock), \
+                mock.patch.object(cbleak.log, 'warning') as warning:
+            driver.enable_notifications()
+            self.assertTrue(wait_until(lambda: NotifyingClientMock.instances
+                                       and 'start_notify' in NotifyingClientMock.instances[-1].calls))
+            client = NotifyingClientMock.instances[-1]
+
+            driver.disconnect()
+            self.assertTrue(wait_until(lambda: 'disconnect' in client.calls))
+
+        self.assertFalse(driver.is_alive())
+        warning.assert_not_called()
+
+    @unittest.skipIf(lt37, "Python version is too low")
+    def test_burst_written_in_order(self):
+        FakeConnection.instances.clear()
+        driver = cbleak.BleakDriver(hub_name='LEGO Move Hub')
+        driver.set_notify_handler(BleakDriverTest.validation_handler)
+        with mock.patch.object(cbleak, 'BleakConnection', FakeConnection):
+            driver.enable_notifications()
+            self.assertTrue(wait_until(lambda: FakeConnection.instances))
+        conn = FakeConnection.instances[0]
+        self.assertTrue(conn.connected.wait(2))
+
+        requests = [(0x0E, bytes([idx])) for idx in range(5)]
+
+        def put_all():
+            # single loop callback, so the task finds the whole burst queued when it wakes up
+            for req in requests:
+                driver.req_queue.put_nowait(req)
+
+        driver._loop.call_soon_threadsafe(put_all)
+        self.assertTrue(wait_until(lambda: len(conn.writes) == len(requests)))
+        self.assertEqual(requests, conn.writes)
+        driver.disconnect()
+
+    @unittest.skipIf(lt37, "Python version is too low")
+    def test_disconnect_flushes_queued_writes(self):
+        FakeConnection.instances.clear()
+        driver = cbleak.BleakDriver(hub_name='LEGO Move Hub')
+        driver.set_notify_handler(BleakDriverTest.validation_handler)
+        with mock.patch.object(cbleak, 'BleakConnection', FakeConnection):
+            driver.enable_notifications()
+            self.assertTrue(wait_until(lambda: FakeConnection.instances))
+        conn = FakeConnection.instances[0]
+        self.assertTrue(conn.connected.wait(2))
+        self.assertTrue(wait_until(lambda: driver._sending))
+
+        requests = [(0x0E, bytes([idx])) for idx in range(5)]
+        for req in requests:
+            driver.write(*req)
+        driver.disconnect()
+
+        self.assertTrue(wait_until(lambda: 'disconnect' in conn.calls))
+        self.assertEqual(requests, conn.writes, 'Writes queued before disconnect are sent')
+        self.assertEqual('disconnect', conn.calls[-1])
+        self.assertTrue(wait_until(lambda: not driver.is_alive()))
+
+    @unittest.skipIf(lt37, "Python version is too low")
+    def test_disconnect_tears_down(self):
+        FakeConnection.instances.clear()
+        drivers = [cbleak.BleakDriver(hub_name='LEGO Move Hub'), cbleak.BleakDriver(hub_name='LEGO Move Hub')]
+        with mock.patch.object(cbleak, 'BleakConnection', FakeConnection):
+            for driver in drivers:
+                driver.set_notify_handler(BleakDriverTest.validation_handler)
+                driver.enable_notifications()
+            self.assertTrue(wait_until(lambda: len(FakeConnection.instances) == 2))
+        self.assertIs(drivers[0]._loop, drivers[1]._loop, 'Drivers share one event loop')
+
+        for conn in FakeConnection.instances:
+            self.assertTrue(conn.connected.wait(2))
+
+        drivers[0].disconnect()
+        self.assertTrue(wait_until(lambda: not drivers[0].is_alive()))
+        self.assertTrue(wait_until(lambda: 'disconnect' in FakeConnection.instances[0].calls),
+                        'Cancelled task closes its connection')
+        self.assertTrue(drivers[1].is_alive(), 'Other driver keeps running')
+        self.assertNotIn('disconnect', FakeConnection.instances[1].calls)
+
+        drivers[1].disconnect()
+        self.assertTrue(wait_until(lambda: 'disconnect' in FakeConnection.instances[1].calls))
+
+    @unittest.skipIf(lt37, "Python version is too low")
+    def test_failed_connect_is_logged(self):
+        driver = cbleak.BleakDriver(hub_name='LEGO Move Hub')
+        driver.set_notify_handler(BleakDriverTest.validation_handler)
+        with mock.patch.object(cbleak, 'BleakConnection', FakeConnection), \
+                mock.patch.object(FakeConnection, 'fail_connect', True), \
+                self.assertLogs('comms-bleak', level='ERROR') as logs:
+            driver.enable_notifications()
+            self.assertTrue(wait_until(lambda: logs.output))
+
+        self.assertFalse(driver.is_alive())
+        self.assertIn('Device not found.', logs.output[0])
+
+    def test_notification_after_shutdown(self):
+        driver = cbleak.BleakDriver()
+        driver.set_notify_handler(BleakDriverTest.validation_handler)
+        driver._handler_executor = cbleak.ThreadPoolExecutor(max_workers=1)
+        driver._handler_executor.shutdown()
+
+        driver._safe_handler(0x0E, bytearray(b'\x01'))  # must not raise inside Bleak's callback
+
     @staticmethod
     def validation_handler(handle, data):
         global last_response
         last_response = (handle, data)
 
 
+HW_CHAR = object()
+
+
+class ServicesMock:
+    def __init__(self):
+        self.lookups = []
+
+    def get_descriptor(self, handle):
+        self.lookups.append(handle)
+        return None
+
+    def get_characteristic(self, uuid):
+        return HW_CHAR if uuid == pylgbst.comms.MOVE_HUB_HW_UUID_CHAR else None
+
+
+class DeviceMock:
+    def __init__(self, address, name):
+        self.address = address
+        self.name = name
+
+
+class ScannerMock:
+    devices = [DeviceMock('00:16:53:A4:CD:7E', 'Other Hub'), DeviceMock('00:16:53:A4:CD:7F', 'LEGO Move Hub')]
+    instances = []
+
+    def __init__(self, detection_callback, **kwargs):
+        self.callback = detection_callback
+        self.stopped = False
+        ScannerMock.instances.append(self)
+
+    async def start(self):
+        for dev in self.devices:
+            self.callback(dev, None)
+
+    async def stop(self):
+        self.stopped = True
+
+
+class ClientMock:
+    def __init__(self, device=None, disconnected_callback=None):
+        self.device = device
+        self.disconnected_callback = disconnected_callback
+        self.services = ServicesMock()
+        self.writes = []
+        self.calls = []
+
+    async def connect(self):
+        self.calls.append('connect')
+        return True
+
+    async def start_notify(self, char, callback):
+        self.calls.append('start_notify')
+
+    async def stop_notify(self, char):
+        self.calls.append('stop_notify')
+
+    async def disconnect(self):
+        self.calls.append('disconnect')
+
+    async def write_gatt_char(self, char, data):
+        self.writes.append((char, bytes(data)))
+
+
+class NotifyingClientMock(ClientMock):
+    """Reports own disconnect through the callback, as BlueZ and WinRT backends do."""
+    instances = []
+
+    def __init__(self, device=None, disconnected_callback=None):
+        super().__init__(device, disconnected_callback)
+        NotifyingClientMock.instances.append(self)
+
+    async def disconnect(self):
+        self.disconnected_callback(self)
+        await super().disconnect()
+
+
+class BleakConnectionTest(unittest.TestCase):
+    @unittest.skipIf(lt37, "Python version is too low")
+    def test_write_caches_descriptor(self):
+        conn = cbleak.BleakConnection()
+        conn._client = ClientMock()
+
+        asyncio.run(conn.write(0x0E, b'\x01\x02'))
+        asyncio.run(conn.write(0x0E, b'\x03'))
+
+        self.assertEqual([0x0E], conn._client.services.lookups, 'Descriptor is resolved once per handle')
+        self.assertEqual([(pylgbst.comms.MOVE_HUB_HW_UUID_CHAR, b'\x01\x02'),
+                          (pylgbst.comms.MOVE_HUB_HW_UUID_CHAR, b'\x03')], conn._client.writes)
+
+    @unittest.skipIf(lt37, "Python version is too low")
+    def test_connect_stops_scan_on_match(self):
+        conn = cbleak.BleakConnection()
+        with mock.patch.object(cbleak.bleak, 'BleakScanner', ScannerMock), \
+                mock.patch.object(cbleak.bleak, 'BleakClient', ClientMock):
+            asyncio.run(conn.connect(hub_name='LEGO Move Hub'))
+
+        self.assertEqual('00:16:53:A4:CD:7F', conn._device.address)
+        self.assertTrue(ScannerMock.instances[-1].stopped, 'Scan is stopped once device matched')
+        self.assertIs(conn._device, conn._client.device)
+        self.assertIs(HW_CHAR, conn._hw_char, 'Default characteristic is resolved on connect')
+        self.assertTrue(conn.is_alive())
+
+        conn._client.disconnected_callback(conn._client)
+        self.assertFalse(conn.is_alive(), 'Disconnect callback updates connection state')
+
+    @unittest.skipIf(lt37, "Python version is too low")
+    def test_connect_device_not_found(self):
+        conn = cbleak.BleakConnection()
+        with mock.patch.object(cbleak.bleak, 'BleakScanner', ScannerMock), \
+                mock.patch.object(cbleak, 'SCAN_TIMEOUT', 0.1):
+            with self.assertRaises(ConnectionError):
+                asyncio.run(conn.connect(hub_name='Missing Hub'))
+
+        self.assertTrue(ScannerMock.instances[-1].stopped, 'Scan is stopped on timeout')
+        self.assertIsNone(conn._client)
+
+    @unittest.skipIf(lt37, "Python version is too low")
+    def test_disconnect_stops_notify_first(self):
+        conn = cbleak.BleakConnection()
+
+        async def session():
+            await conn.connect(hub_name='LEGO Move Hub')
+            await conn.set_notify_handler(lambda handle, data: None)
+            await conn.disconnect()
+
+        with mock.patch.object(cbleak.bleak, 'BleakScanner', ScannerMock), \
+                mock.patch.object(cbleak.bleak, 'BleakClient', ClientMock):
+            asyncio.run(session())
+
+        self.assertEqual(['connect', 'start_notify', 'stop_notify', 'disconnect'], conn._client.calls)
+
+    @unittest.skipIf(lt37, "Python version is too low")
+    def test_disconnect_when_stop_notify_fails(self):
+        conn = cbleak.BleakConnection()
+
+        async def failing_stop_notify(char):
+            conn._client.calls.append('stop_notify')
+            raise bleak.exc.BleakError('Not connected')
+
+        async def session():
+            await conn.connect(hub_name='LEGO Move Hub')
+            await conn.set_notify_handler(lambda handle, data: None)
+            conn._client.stop_notify = failing_stop_notify
+            await conn.disconnect()
+
+        with mock.patch.object(cbleak.bleak, 'BleakScanner', ScannerMock), \
+                mock.patch.object(cbleak.bleak, 'BleakClient', ClientMock):
+            with self.assertLogs('comms-bleak', level='WARNING'):
+                asyncio.run(session())
+
+        self.assertEqual(['connect', 'start_notify', 'stop_notify', 'disconnect'], conn._client.calls)
+
+    @unittest.skipIf(lt37, "Python version is too low")
+    def test_disconnect_after_cancelled_connect(self):
+        conn = cbleak.BleakConnection()
+
+        async def hanging_connect():
+            conn._client.calls.append('connect')
+            await asyncio.sleep(10)
+
+        class HangingClientMock(ClientMock):
+            connect = staticmethod(hanging_connect)
+
+        async def session():
+            task = asyncio.ensure_future(conn.connect(hub_name='LEGO Move Hub'))
+            while conn._client is None:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            await conn.disconnect()
+
+        with mock.patch.object(cbleak.bleak, 'BleakScanner', ScannerMock), \
+                mock.patch.object(cbleak.bleak, 'BleakClient', HangingClientMock):
+            asyncio.run(session())
+
+        self.assertFalse(conn.is_alive())
+        self.assertEqual(['connect', 'disconnect'], conn._client.calls, 'Half-open client is released')
+
+
 if __name__ == '__main__':
     unittest.main()